@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
+import heapq
 import time
 import random
 import logging
-import math
 
 import attr
+import six
 
-from .utils import extract_proxy_hostport
+from .utils import extract_proxy_hostport, proxy_slot_key
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +32,11 @@ class Proxies(object):
     'Dead' proxies move to 'unchecked' after a timeout (they are called
     'reanimated'). This timeout increases exponentially after each
     unsuccessful attempt to use a proxy.
+
+    Each proxy has a weight; available proxies are selected with
+    probability proportional to their weights. By default all weights
+    are equal; :meth:`reanimate` can refresh them from downloader slot
+    delays so that faster proxies are chosen more often.
     """
     def __init__(self, proxy_list, backoff=None):
         self.proxies = {url: ProxyState() for url in proxy_list}
@@ -38,20 +44,107 @@ class Proxies(object):
             extract_proxy_hostport(proxy): proxy
             for proxy in self.proxies
         }
+        # immutable after init; avoids re-deriving slot keys on
+        # every weight refresh
+        self._slot_keys = {
+            proxy: proxy_slot_key(proxy)
+            for proxy in self.proxies
+        }
         self.unchecked = set(self.proxies.keys())
         self.good = set()
         self.dead = set()
+        # unchecked proxies which previously failed
+        self._reanimated = set()
 
         if backoff is None:
             backoff = exp_backoff_full_jitter
         self.backoff = backoff
 
+        self._cached = None
+        # set when proxy weights changed but availability didn't;
+        # get_random then rebuilds the alias table without re-filtering
+        self._weights_dirty = False
+        # pre-drawn proxies, served LIFO by get_random; emptied
+        # whenever the selection cache is invalidated
+        self._pick_buffer = []
+        # min-heap of (deadline, proxy); may contain stale entries,
+        # which are dropped lazily in reanimate()
+        self._dead_heap = []
+        # running sum of backoff times of dead proxies, so that
+        # mean_backoff_time doesn't have to scan them
+        self._dead_backoff_sum = 0.0
+
+    #: how many proxies get_random pre-draws per batch
+    PICK_BATCH_SIZE = 64
+
     def get_random(self):
         """ Return a random available proxy (either good or unchecked) """
-        available = list(self.unchecked | self.good)
-        if not available:
+        buf = self._pick_buffer
+        if buf:
+            return buf.pop()
+        cached = self._cached
+        if cached is None:
+            cached = self._cached = self._build_cache()
+        elif self._weights_dirty:
+            cached = self._cached = self._build_cache(cached[0])
+        self._weights_dirty = False
+        available, prob, alias = cached
+        n = len(available)
+        if not n:
             return None
-        return random.choice(available)
+        rnd = random.random
+        if prob is None:
+            # uniform weights: a plain index draw is all that's needed
+            buf.extend(available[int(rnd() * n)]
+                       for _ in range(self.PICK_BATCH_SIZE))
+        else:
+            for _ in range(self.PICK_BATCH_SIZE):
+                # one uniform draw serves both as the bucket index
+                # (integer part) and as the alias coin flip
+                # (fractional part)
+                r = rnd() * n
+                i = int(r)
+                buf.append(available[i if r - i < prob[i] else alias[i]])
+        return buf.pop()
+
+    def _build_cache(self, available=None):
+        """
+        Build the alias table used for weighted random selection
+        (Vose's method: O(n) to build, O(1) per draw).
+        """
+        if available is None:
+            available = list(self.unchecked | self.good)
+        n = len(available)
+        if not n:
+            return available, [], []
+        proxies = self.proxies
+        weights = [proxies[p].weight for p in available]
+        first = weights[0]
+        if all(w == first for w in weights):
+            # uniform weights (e.g. before any delay measurements):
+            # no alias table is needed
+            return available, None, None
+        scale = n / sum(weights)
+        prob = [w * scale for w in weights]
+        alias = list(range(n))
+        small = [i for i, x in enumerate(prob) if x < 1.0]
+        large = [i for i, x in enumerate(prob) if x >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            alias[s] = l
+            prob[l] -= 1.0 - prob[s]
+            if prob[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        return available, prob, alias
+
+    def _clear_cache(self):
+        """ Invalidate structures cached for random proxy selection """
+        self._cached = None
+        self._weights_dirty = False
+        del self._pick_buffer[:]
 
     def get_proxy(self, proxy_address):
         """
@@ -61,101 +154,237 @@ class Proxies(object):
         """
         if not proxy_address:
             return None
+        if not isinstance(proxy_address, six.string_types):
+            # e.g. True, stored in _rotating_proxy meta by old versions
+            return None
+        if proxy_address in self.proxies:
+            # fast path: proxy_address is a canonical proxy URL (this is
+            # what the middleware stores in request.meta), so there is
+            # no need to parse it
+            return proxy_address
         hostport = extract_proxy_hostport(proxy_address)
         return self.proxies_by_hostport.get(hostport, None)
 
     def mark_dead(self, proxy, _time=None):
         """ Mark a proxy as dead """
         if proxy not in self.proxies:
-            logger.warn("Proxy <%s> was not found in proxies list" % proxy)
+            logger.warning("Proxy <%s> was not found in proxies list", proxy)
             return
 
         if proxy in self.good:
-            logger.debug("GOOD proxy became DEAD: <%s>" % proxy)
+            logger.debug("GOOD proxy became DEAD: <%s>", proxy)
         else:
-            logger.debug("Proxy <%s> is DEAD" % proxy)
+            logger.debug("Proxy <%s> is DEAD", proxy)
 
+        was_dead = proxy in self.dead
+        if not was_dead:
+            # removal from the available list requires a rebuild
+            self._clear_cache()
         self.unchecked.discard(proxy)
         self.good.discard(proxy)
         self.dead.add(proxy)
+        self._reanimated.discard(proxy)
 
         now = _time or time.time()
         state = self.proxies[proxy]
+        if was_dead:
+            self._dead_backoff_sum -= state.backoff_time
         state.backoff_time = self.backoff(state.failed_attempts)
         state.next_check = now + state.backoff_time
         state.failed_attempts += 1
+        self._dead_backoff_sum += state.backoff_time
+        heapq.heappush(self._dead_heap, (state.next_check, proxy))
 
     def mark_good(self, proxy):
         """ Mark a proxy as good """
         if proxy not in self.proxies:
-            logger.warn("Proxy <%s> was not found in proxies list" % proxy)
+            logger.warning("Proxy <%s> was not found in proxies list", proxy)
             return
 
         if proxy not in self.good:
-            logger.debug("Proxy <%s> is GOOD" % proxy)
+            logger.debug("Proxy <%s> is GOOD", proxy)
 
+        was_dead = proxy in self.dead
         self.unchecked.discard(proxy)
         self.dead.discard(proxy)
         self.good.add(proxy)
+        self._reanimated.discard(proxy)
+        if was_dead:
+            self._dead_backoff_sum -= self.proxies[proxy].backoff_time
+        if was_dead and self._cached is not None:
+            # a single proxy became available: keep the cached list and
+            # rebuild the alias table lazily instead of re-filtering
+            self._cached[0].append(proxy)
+            self._weights_dirty = True
         self.proxies[proxy].failed_attempts = 0
 
-    def reanimate(self, _time=None):
-        """ Move dead proxies to unchecked if a backoff timeout passes """
+    def reanimate(self, _time=None, slots=None):
+        """
+        Move dead proxies to unchecked if a backoff timeout passes.
+
+        When ``slots`` is passed (a mapping of downloader slot keys to
+        slot objects with a ``delay`` attribute), proxy weights are
+        refreshed from the observed download delays.
+        """
+        slot_delays = None
+        if slots is not None:
+            slot_delays = {key: getattr(slot, 'delay', None)
+                           for key, slot in slots.items()}
         n_reanimated = 0
         now = _time or time.time()
-        for proxy in list(self.dead):
-            state = self.proxies[proxy]
-            assert state.next_check is not None
-            if state.next_check <= now:
-                self.dead.remove(proxy)
-                self.unchecked.add(proxy)
-                n_reanimated += 1
+        proxies = self.proxies
+        dead, unchecked = self.dead, self.unchecked
+        heap = self._dead_heap
+        while heap and heap[0][0] <= now:
+            _, proxy = heapq.heappop(heap)
+            if proxy not in dead:
+                # stale entry: proxy was revived by other means
+                continue
+            if proxies[proxy].next_check > now:
+                # stale entry: proxy died again with a later deadline
+                continue
+            dead.remove(proxy)
+            unchecked.add(proxy)
+            self._reanimated.add(proxy)
+            self._dead_backoff_sum -= proxies[proxy].backoff_time
+            n_reanimated += 1
+        if n_reanimated:
+            self._clear_cache()
+        if slot_delays is not None:
+            self.apply_weights(self.compute_weights(slot_delays))
         return n_reanimated
 
+    #: smoothing factor for the per-proxy delay estimate; lower values
+    #: make weights less sensitive to a single slow or fast response
+    EWMA_ALPHA = 0.2
+
+    def compute_weights(self, slot_delays):
+        """
+        Compute refreshed proxy weights from downloader slot delays
+        (a mapping of slot keys to delays, in seconds), without
+        modifying any state. Weight is an inverse of the smoothed
+        (exponentially-weighted moving average) delay; proxies without
+        a known delay get the average delay of the other proxies.
+
+        ``slot_delays`` must be a plain dict snapshotted on the reactor
+        thread, not the live downloader slots; given that, this only
+        reads shared state and is safe to run off the reactor thread.
+        Pass the result to :meth:`apply_weights` on the reactor thread.
+        """
+        # With ROTATING_PROXY_SLOT_PER_DESTINATION the downloader keeps
+        # one slot per '<destination>|<proxy host>' pair, so delays are
+        # averaged over every slot which ends with the proxy host.
+        delay_sums, delay_counts = {}, {}
+        for key, slot_delay in slot_delays.items():
+            if not slot_delay:
+                continue
+            key = key.rpartition('|')[2]
+            delay_sums[key] = delay_sums.get(key, 0.0) + slot_delay
+            delay_counts[key] = delay_counts.get(key, 0) + 1
+
+        updates = {}
+        total_delay = 0.0
+        n_known = 0
+        alpha = self.EWMA_ALPHA
+        slot_keys = self._slot_keys
+        for proxy, state in self.proxies.items():
+            key = slot_keys[proxy]
+            delay = (delay_sums[key] / delay_counts[key]
+                     if key in delay_sums else None)
+            ewma = state.ewma_delay
+            if delay:
+                if ewma is None:
+                    ewma = delay
+                else:
+                    ewma += alpha * (delay - ewma)
+            if ewma is not None:
+                total_delay += ewma
+                n_known += 1
+            updates[proxy] = ewma
+        if not n_known:
+            return None
+        average_delay = total_delay / n_known
+        return {
+            proxy: (ewma, 1.0 / (ewma if ewma is not None else average_delay))
+            for proxy, ewma in updates.items()
+        }
+
+    def apply_weights(self, updates):
+        """ Store the result of :meth:`compute_weights` """
+        if not updates:
+            return
+        proxies = self.proxies
+        for proxy, (ewma, weight) in updates.items():
+            state = proxies.get(proxy, None)
+            if state is None:
+                continue
+            if ewma is not None:
+                state.ewma_delay = ewma
+            state.weight = weight
+        if self._cached is not None:
+            # only weights changed: the next get_random rebuilds the
+            # alias table over the cached available list without
+            # re-filtering it
+            self._weights_dirty = True
+            del self._pick_buffer[:]
+
     def reset(self):
         """ Mark all dead proxies as unchecked """
         for proxy in list(self.dead):
             self.dead.remove(proxy)
             self.unchecked.add(proxy)
+            self._reanimated.add(proxy)
+        self._dead_backoff_sum = 0.0
+        self._clear_cache()
 
     @property
     def mean_backoff_time(self):
         if not self.dead:
             return 0.0
-        total_backoff = sum(self.proxies[p].backoff_time for p in self.dead)
-        return float(total_backoff) / len(self.dead)
+        return self._dead_backoff_sum / len(self.dead)
 
     @property
     def reanimated(self):
-        return [p for p in self.unchecked if self.proxies[p].failed_attempts]
+        return list(self._reanimated)
+
+    def status_counts(self):
+        """ Return the number of proxies in each state, as a dict """
+        n_reanimated = len(self._reanimated)
+        return {
+            'good': len(self.good),
+            'dead': len(self.dead),
+            'unchecked': len(self.unchecked) - n_reanimated,
+            'reanimated': n_reanimated,
+        }
 
     def __str__(self):
-        n_reanimated = len(self.reanimated)
-        return "Proxies(good: {}, dead: {}, unchecked: {}, reanimated: {}, " \
-               "mean backoff time: {}s)".format(
-            len(self.good), len(self.dead),
-            len(self.unchecked) - n_reanimated, n_reanimated,
-            int(self.mean_backoff_time),
-        )
+        counts = self.status_counts()
+        return "Proxies(good: {good}, dead: {dead}, unchecked: {unchecked}, " \
+               "reanimated: {reanimated}, " \
+               "mean backoff time: {mean_backoff}s)".format(
+            mean_backoff=int(self.mean_backoff_time), **counts)
 
 
-@attr.s
+@attr.s(slots=True)
 class ProxyState(object):
     failed_attempts = attr.ib(default=0)
     next_check = attr.ib(default=None)
     backoff_time = attr.ib(default=None)  # for debugging
+    weight = attr.ib(default=1.0)
+    ewma_delay = attr.ib(default=None)  # smoothed download delay
 
 
 def exp_backoff(attempt, cap=3600, base=300):
     """ Exponential backoff time """
-    # this is a numerically stable version of
-    # min(cap, base * 2 ** attempt)
-    max_attempts = math.log(cap / base, 2)
-    if attempt <= max_attempts:
-        return base * 2 ** attempt
-    return cap
+    # this is an overflow-safe version of min(cap, base * 2 ** attempt):
+    # the cap is reached after a few dozen doublings for any sane
+    # base/cap combination, so large attempt values short-circuit
+    # before 2 ** attempt gets huge.
+    if attempt > 64:
+        return cap
+    return min(cap, base * 2 ** attempt)
 
 
 def exp_backoff_full_jitter(*args, **kwargs):
     """ Exponential backoff time with Full Jitter """
-    return random.uniform(0, exp_backoff(*args, **kwargs))
+    return random.random() * exp_backoff(*args, **kwargs)
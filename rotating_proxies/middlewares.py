@@ -7,9 +7,10 @@ from six.moves.urllib.parse import urlsplit
 
 from scrapy.exceptions import CloseSpider, NotConfigured
 from scrapy import signals
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.misc import load_object
 from scrapy.utils.url import add_http_if_no_scheme
-from twisted.internet import task
+from twisted.internet import task, threads
 
 from .expire import Proxies, exp_backoff_full_jitter
 
@@ -38,6 +39,10 @@ class RotatingProxyMiddleware(object):
 
     Dead proxies are re-checked with a randomized exponential backoff.
 
+    Alive proxies are selected with probability inversely proportional
+    to the download delay of their downloader slots, so faster proxies
+    get more requests.
+
     By default, all default Scrapy concurrency options (DOWNLOAD_DELAY,
     AUTHTHROTTLE_..., CONCURRENT_REQUESTS_PER_DOMAIN, etc) become per-proxy
     for proxied requests when RotatingProxyMiddleware is enabled.
@@ -62,9 +67,15 @@ class RotatingProxyMiddleware(object):
       Default is 300 (i.e. 5 min).
     * ``ROTATING_PROXY_BACKOFF_CAP`` - backoff time cap, in seconds.
       Default is 3600 (i.e. 60 min).
+    * ``ROTATING_PROXY_SLOT_PER_DESTINATION`` - When True, download
+      slots are per (destination host, proxy) pair instead of per
+      proxy, so per-domain concurrency and delay options keep limiting
+      the total load on each target website even with many proxies.
+      Default: False.
     """
     def __init__(self, proxy_list, logstats_interval, stop_if_no_proxies,
-                 max_proxies_to_try, backoff_base, backoff_cap, crawler):
+                 max_proxies_to_try, backoff_base, backoff_cap, crawler,
+                 slot_per_destination=False):
 
         backoff = partial(exp_backoff_full_jitter, base=backoff_base, cap=backoff_cap)
         self.proxies = Proxies(self.cleanup_proxy_list(proxy_list),
@@ -73,11 +84,21 @@ class RotatingProxyMiddleware(object):
         self.reanimate_interval = 5
         self.stop_if_no_proxies = stop_if_no_proxies
         self.max_proxies_to_try = max_proxies_to_try
+        self.slot_per_destination = slot_per_destination
+        self.crawler = crawler
         self.stats = crawler.stats
 
         self.log_task = None
         self.reanimate_task = None
 
+        # prefilled for the whole proxy list so no URL parsing is left
+        # on the request path; get_proxy_slot still falls back to
+        # parsing for proxies it has never seen
+        self._proxy_slots = {
+            proxy: urlsplit(proxy).hostname
+            for proxy in self.proxies.proxies
+        }
+
     @classmethod
     def from_crawler(cls, crawler):
         s = crawler.settings
@@ -97,6 +118,8 @@ class RotatingProxyMiddleware(object):
             backoff_base=s.getfloat('ROTATING_PROXY_BACKOFF_BASE', 300),
             backoff_cap=s.getfloat('ROTATING_PROXY_BACKOFF_CAP', 3600),
             crawler=crawler,
+            slot_per_destination=s.getbool(
+                'ROTATING_PROXY_SLOT_PER_DESTINATION', False),
         )
         crawler.signals.connect(mw.engine_started,
                                 signal=signals.engine_started)
@@ -114,10 +137,33 @@ class RotatingProxyMiddleware(object):
             self.reanimate_task.start(self.reanimate_interval, now=False)
 
     def reanimate_proxies(self):
+        # checking backoff deadlines pops a heap and is cheap, so it
+        # runs right here on the reactor thread
         n_reanimated = self.proxies.reanimate()
         if n_reanimated:
             logger.debug("%s proxies moved from 'dead' to 'reanimated'",
                          n_reanimated)
+        downloader = getattr(self.crawler.engine, 'downloader', None)
+        slots = getattr(downloader, 'slots', None)
+        if slots:
+            # snapshot the delays here, on the reactor thread: Scrapy
+            # adds and garbage-collects downloader slots while a crawl
+            # runs, so the live dict must not be iterated from a
+            # worker thread
+            delays = {key: getattr(slot, 'delay', None)
+                      for key, slot in slots.items()}
+            # the weight refresh walks the whole proxy list; compute it
+            # in a worker thread and apply the result on the reactor
+            d = threads.deferToThread(self.proxies.compute_weights, delays)
+            d.addCallback(self.proxies.apply_weights)
+            d.addErrback(self._weight_refresh_failed)
+            return d
+
+    def _weight_refresh_failed(self, failure):
+        # swallow the failure: if it reached the LoopingCall, the
+        # errback of LoopingCall.start would stop reanimation for the
+        # rest of the crawl
+        logger.warning("Proxy weight refresh failed: %s", failure.value)
 
     def engine_stopped(self):
         if self.log_task and self.log_task.running:
@@ -126,34 +172,54 @@ class RotatingProxyMiddleware(object):
         if self.reanimate_task and self.reanimate_task.running:
             self.reanimate_task.stop()
 
+        # make sure final stats reflect the last proxy states
+        self._update_stats()
+
     def process_request(self, request, spider):
-        if 'proxy' in request.meta and not request.meta.get('_rotating_proxy'):
+        meta = request.meta
+        # a proxy set by the user (not by this middleware) is left
+        # alone, including an explicit None which disables proxying
+        if 'proxy' in meta and '_rotating_proxy' not in meta:
             return
-        proxy = self.proxies.get_random()
+        proxies = self.proxies
+        proxy = proxies.get_random()
         if not proxy:
             if self.stop_if_no_proxies:
                 raise CloseSpider("no_proxies")
             else:
-                logger.warn("No proxies available; marking all proxies "
-                            "as unchecked")
-                self.proxies.reset()
-                proxy = self.proxies.get_random()
+                logger.warning("No proxies available; marking all proxies "
+                               "as unchecked")
+                proxies.reset()
+                proxy = proxies.get_random()
                 if proxy is None:
                     logger.error("No proxies available even after a reset.")
                     raise CloseSpider("no_proxies_after_reset")
 
-        request.meta['proxy'] = proxy
-        request.meta['download_slot'] = self.get_proxy_slot(proxy)
-        request.meta['_rotating_proxy'] = True
+        slot = self.get_proxy_slot(proxy)
+        if self.slot_per_destination:
+            slot = '%s|%s' % (urlparse_cached(request).hostname, slot)
+
+        # '_rotating_proxy' doubles as the "chosen by this middleware"
+        # flag and a record of which proxy was chosen, so result
+        # handlers need a single meta lookup.
+        meta['proxy'] = proxy
+        meta['download_slot'] = slot
+        meta['_rotating_proxy'] = proxy
 
     def get_proxy_slot(self, proxy):
         """
         Return downloader slot for a proxy.
         By default it doesn't take port in account, i.e. all proxies with
         the same hostname / ip address share the same slot.
+
+        Results are cached, as this is called for every request and
+        URL parsing is relatively expensive.
         """
         # FIXME: an option to use website address as a part of slot as well?
-        return urlsplit(proxy).hostname
+        slot = self._proxy_slots.get(proxy, None)
+        if slot is None:
+            slot = self._proxy_slots[proxy] = urlsplit(proxy).hostname
+        return slot
 
     def process_exception(self, request, exception, spider):
         return self._handle_result(request, spider)
@@ -162,25 +228,27 @@ class RotatingProxyMiddleware(object):
         return self._handle_result(request, spider) or response
 
     def _handle_result(self, request, spider):
-        proxy = self.proxies.get_proxy(request.meta.get('proxy', None))
-        if not (proxy and request.meta.get('_rotating_proxy')):
+        meta = request.meta
+        proxy_url = meta.get('_rotating_proxy', None)
+        if proxy_url is True:
+            # requests restored from disk queues of older versions
+            # store True here; the proxy URL is then in meta['proxy']
+            proxy_url = meta.get('proxy', None)
+        proxy = self.proxies.get_proxy(proxy_url)
+        if not proxy:
             return
-        self.stats.set_value('proxies/unchecked', len(self.proxies.unchecked) - len(self.proxies.reanimated))
-        self.stats.set_value('proxies/reanimated', len(self.proxies.reanimated))
-        self.stats.set_value('proxies/mean_backoff', self.proxies.mean_backoff_time)
-        ban = request.meta.get('_ban', None)
+        ban = meta.get('_ban', None)
         if ban is True:
             self.proxies.mark_dead(proxy)
-            self.stats.set_value('proxies/dead', len(self.proxies.dead))
             return self._retry(request, spider)
         elif ban is False:
             self.proxies.mark_good(proxy)
-            self.stats.set_value('proxies/good', len(self.proxies.good))
 
     def _retry(self, request, spider):
-        retries = request.meta.get('proxy_retry_times', 0) + 1
-        max_proxies_to_try = request.meta.get('max_proxies_to_try',
-                                              self.max_proxies_to_try)
+        meta = request.meta
+        retries = meta.get('proxy_retry_times', 0) + 1
+        max_proxies_to_try = meta.get('max_proxies_to_try',
+                                      self.max_proxies_to_try)
 
         if retries <= max_proxies_to_try:
             logger.debug("Retrying %(request)s with another proxy "
@@ -189,10 +257,10 @@ class RotatingProxyMiddleware(object):
                          {'request': request, 'retries': retries,
                           'max_proxies_to_try': max_proxies_to_try},
                          extra={'spider': spider})
-            retryreq = request.copy()
-            retryreq.meta['proxy_retry_times'] = retries
-            retryreq.dont_filter = True
-            return retryreq
+            return request.replace(
+                meta=dict(meta, proxy_retry_times=retries),
+                dont_filter=True,
+            )
         else:
             logger.debug("Gave up retrying %(request)s (failed %(retries)d "
                          "times with different proxies)",
@@ -200,16 +268,37 @@ class RotatingProxyMiddleware(object):
                          extra={'spider': spider})
 
     def log_stats(self):
-        logger.info('%s' % self.proxies)
+        logger.info('%s', self.proxies)
+        self._update_stats()
+
+    def _update_stats(self):
+        values = {
+            'proxies/%s' % status: count
+            for status, count in self.proxies.status_counts().items()
+        }
+        values['proxies/mean_backoff'] = self.proxies.mean_backoff_time
+        stats_dict = getattr(self.stats, '_stats', None)
+        if stats_dict is not None:
+            # default StatsCollector stores values in a plain dict;
+            # update it in one go instead of one set_value per key
+            stats_dict.update(values)
+        else:
+            for key, value in values.items():
+                self.stats.set_value(key, value)
 
     @classmethod
     def cleanup_proxy_list(cls, proxy_list):
-        lines = [line.strip() for line in proxy_list]
-        return list({
-            add_http_if_no_scheme(url)
-            for url in lines
-            if url and not url.startswith('#')
-        })
+        seen = set()
+        result = []
+        for line in proxy_list:
+            url = line.strip()
+            if not url or url.startswith('#'):
+                continue
+            url = add_http_if_no_scheme(url)
+            if url not in seen:
+                seen.add(url)
+                result.append(url)
+        return result
 
 
 class BanDetectionMiddleware(object):
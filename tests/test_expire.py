@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import random
+from collections import Counter
+
 from rotating_proxies.expire import Proxies, exp_backoff
 
 
@@ -12,6 +15,7 @@ def test_proxies():
     assert proxy in proxy_list
     proxy = p.get_proxy('wom')
     assert not proxy
+    assert p.get_proxy(True) is None
 
     p.mark_dead('bar')
     p.mark_dead('baz')
@@ -54,6 +58,84 @@ def test_reanimate_reset():
     assert all(proxy.failed_attempts > 0 for proxy in p.proxies.values())
 
 
+def test_weighted_get_random():
+    p = Proxies(['foo', 'bar', 'baz'])
+    p.proxies['foo'].weight = 1.0
+    p.proxies['bar'].weight = 0.0
+    p.proxies['baz'].weight = 0.0
+    assert all(p.get_random() == 'foo' for _ in range(200))
+
+
+def test_weighted_get_random_distribution():
+    random.seed(42)
+    weights = {'foo': 4.0, 'bar': 2.0, 'baz': 1.0, 'egg': 1.0}
+    p = Proxies(list(weights.keys()))
+    for proxy, weight in weights.items():
+        p.proxies[proxy].weight = weight
+    n_draws = 50000
+    counts = Counter(p.get_random() for _ in range(n_draws))
+    total_weight = sum(weights.values())
+    for proxy, weight in weights.items():
+        expected = n_draws * weight / total_weight
+        assert abs(counts[proxy] - expected) < 0.02 * n_draws
+
+
+def test_get_random_after_mark_good():
+    random.seed(42)
+    p = Proxies(['foo', 'bar'])
+    p.mark_dead('bar')
+    assert p.get_random() == 'foo'
+    p.mark_good('bar')
+    # 'bar' must become drawable once the pre-drawn batch is consumed
+    drawn = set(p.get_random() for _ in range(p.PICK_BATCH_SIZE * 4))
+    assert drawn == {'foo', 'bar'}
+
+
+def test_mean_backoff_time():
+    p = Proxies(['foo', 'bar', 'baz'])
+    assert p.mean_backoff_time == 0.0
+
+    p.mark_dead('foo', 1)
+    p.mark_dead('bar', 1)
+    states = p.proxies
+    expected = (states['foo'].backoff_time + states['bar'].backoff_time) / 2
+    assert abs(p.mean_backoff_time - expected) < 1e-9
+
+    p.mark_good('foo')
+    assert abs(p.mean_backoff_time - states['bar'].backoff_time) < 1e-9
+
+    p.reset()
+    assert p.mean_backoff_time == 0.0
+
+
+def test_update_weights():
+    class Slot(object):
+        def __init__(self, delay):
+            self.delay = delay
+
+    p = Proxies(['http://foo:8000', 'http://bar:8000'])
+    p.reanimate(slots={'foo': Slot(1.0), 'bar': Slot(4.0)})
+    assert p.proxies['http://foo:8000'].weight == 1.0
+    assert p.proxies['http://bar:8000'].weight == 0.25
+
+
+def test_update_weights_slot_per_destination():
+    class Slot(object):
+        def __init__(self, delay):
+            self.delay = delay
+
+    p = Proxies(['http://foo:8000', 'http://bar:8000'])
+    # slot keys as composed by ROTATING_PROXY_SLOT_PER_DESTINATION:
+    # delays are averaged over destinations of the same proxy
+    p.reanimate(slots={
+        'example.com|foo': Slot(1.0),
+        'scrapy.org|foo': Slot(3.0),
+        'example.com|bar': Slot(8.0),
+    })
+    assert p.proxies['http://foo:8000'].weight == 0.5
+    assert p.proxies['http://bar:8000'].weight == 0.125
+
+
 def test_exp_backoff():
     assert exp_backoff(0, 3600.0, 300.0) == 300
     assert exp_backoff(1, 3600.0, 300.0) == 600
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from scrapy.http import Request
+from scrapy.utils.test import get_crawler
+
+from rotating_proxies.middlewares import RotatingProxyMiddleware
+
+
+def get_middleware(**settings):
+    settings.setdefault('ROTATING_PROXY_LIST', ['http://foo:8000'])
+    crawler = get_crawler(settings_dict=settings)
+    return RotatingProxyMiddleware.from_crawler(crawler)
+
+
+def test_process_request():
+    mw = get_middleware()
+    request = Request('http://example.com')
+    mw.process_request(request, spider=None)
+    assert request.meta['proxy'] == 'http://foo:8000'
+    assert request.meta['download_slot'] == 'foo'
+
+
+def test_slot_per_destination():
+    mw = get_middleware(ROTATING_PROXY_SLOT_PER_DESTINATION=True)
+    request = Request('http://example.com')
+    mw.process_request(request, spider=None)
+    assert request.meta['proxy'] == 'http://foo:8000'
+    assert request.meta['download_slot'] == 'example.com|foo'
+
+
+def test_user_proxy_is_kept():
+    mw = get_middleware()
+    request = Request('http://example.com',
+                      meta={'proxy': 'http://my-proxy:3128'})
+    assert mw.process_request(request, spider=None) is None
+    assert request.meta['proxy'] == 'http://my-proxy:3128'
+
+
+def test_legacy_rotating_proxy_meta():
+    # requests restored from disk queues of older versions store
+    # _rotating_proxy=True, with the proxy URL in meta['proxy']
+    mw = get_middleware()
+    request = Request('http://example.com',
+                      meta={'proxy': 'http://foo:8000',
+                            '_rotating_proxy': True,
+                            '_ban': False})
+    assert mw._handle_result(request, spider=None) is None
+    assert 'http://foo:8000' in mw.proxies.good
+
+
+def test_proxy_none_disables_rotation():
+    mw = get_middleware()
+    request = Request('http://example.com', meta={'proxy': None})
+    assert mw.process_request(request, spider=None) is None
+    assert request.meta['proxy'] is None
+    assert '_rotating_proxy' not in request.meta